@@ -2,6 +2,7 @@ from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import os
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 from datetime import datetime, timedelta
 import requests
@@ -11,8 +12,26 @@ from io import BytesIO
 import traceback
 from http.server import BaseHTTPRequestHandler
 import json
+import ast
+import hashlib
+import shutil
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# numexpr is optional; when installed, large weighted-rank calculations use it
+try:
+    import numexpr  # noqa: F401
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+
+# polars is optional; when installed, large historical aggregations use it
+try:
+    import polars as pl
+    HAS_POLARS = True
+except ImportError:
+    HAS_POLARS = False
 
 app = Flask(__name__)
 # Configure CORS for compatibility with Next.js
@@ -70,8 +89,74 @@ latest_rankings = {
     "by_publisher": {}
 }
 
+# latest_rankings serialized once when it is stored, so GET requests only send bytes
+latest_rankings_json = b''
+
+# Fields every ranking record carries, with the value used when a record lacks one
+RANKING_RECORD_DEFAULTS = {
+    'expected_clicks': 0,
+    'budget_cap': 0,
+    'CTR': 0,
+    'EPC': 0,
+    'avg_revenue': 0,
+    'distribution': 0,
+    'final_rank': 0,
+    'tags': '',
+    'subcategory': ''
+}
+
+def store_latest_rankings(final_rankings):
+    """Store the final rankings for the get-rankings endpoints, grouped by publisher and pre-serialized"""
+    global latest_rankings, latest_rankings_json
+    
+    # Convert the final_rankings DataFrame to a list of dictionaries
+    all_publishers_data = final_rankings.to_dict('records')
+    
+    # Group rankings by publisher and ensure all needed fields are present
+    by_publisher = {}
+    for record in all_publishers_data:
+        for field, default in RANKING_RECORD_DEFAULTS.items():
+            record.setdefault(field, default)
+        by_publisher.setdefault(record.get('publisher', 'Unknown'), []).append(record)
+    
+    rankings = {
+        "all_publishers": all_publishers_data,
+        "by_publisher": by_publisher
+    }
+    # Serialize before publishing, then swap both globals together so a concurrent GET never
+    # sees new rankings with a stale or empty payload. An empty run publishes no payload (404).
+    rankings_json = app.json.dumps(rankings).encode() if all_publishers_data else b''
+    latest_rankings, latest_rankings_json = rankings, rankings_json
+
 ALLOWED_EXTENSIONS = {'csv', 'xlsx'}
 
+# Downloadable report bytes keyed by path, reused until the file's mtime or size changes
+_FILE_CACHE = {}
+
+# Excel writes run on one shared background pool so they overlap with the next pipeline
+# stage; a single module-level pool avoids leaving an executor behind on every request
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+
+# Intermediate step1-3 Excel files are only written when PLANNER_DEBUG (or DEBUG_DUMPS) is set
+PLANNER_DEBUG = bool(os.environ.get('PLANNER_DEBUG') or os.environ.get('DEBUG_DUMPS'))
+
+# Row count above which the weighted rank is evaluated with numexpr (when available)
+NUMEXPR_MIN_ROWS = 10000
+
+# Historical row count above which the metrics aggregation runs in polars (when available)
+POLARS_MIN_ROWS = 50000
+
+# Above this many rows the combined "All Publishers" sheet is left out of the final workbook;
+# every row is still written to its publisher's sheet
+ALL_PUBLISHERS_SHEET_MAX_ROWS = 250000
+
+# Excel's per-sheet limit (1,048,576 rows less the header); larger publishers span several sheets
+EXCEL_SHEET_MAX_ROWS = 1048575
+
+# When served behind nginx, set to the internal location mapped to OUTPUT_FOLDER so
+# downloads are handed off with X-Accel-Redirect instead of streamed through Flask
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -107,6 +192,87 @@ def json_to_csv(data, filename):
         logger.error(f"Error converting JSON to CSV: {str(e)}")
         raise
 
+def records_to_frame(data):
+    """Build a DataFrame straight from JSON records, applying the same renames as json_to_csv"""
+    df = pd.DataFrame(data)
+    
+    # Rename distribution_count to distribution if needed in user input
+    if 'distribution_count' in df.columns:
+        if 'distribution' in df.columns:
+            df['distribution'] = df['distribution'].fillna(df['distribution_count'])
+        else:
+            df['distribution'] = df['distribution_count']
+    return df
+
+def normalize_input_frame(df, usecols, dtype, converters=None):
+    """Give a frame built from JSON records the columns and dtypes read_csv would produce for the same data"""
+    df = df[[col for col in df.columns if col in usecols]].copy()
+    
+    # read_csv treats empty cells as missing
+    df = df.replace('', np.nan)
+    
+    for col, converter in (converters or {}).items():
+        if col in df.columns:
+            df[col] = df[col].map(converter)
+    for col, col_dtype in dtype.items():
+        if col not in df.columns:
+            continue
+        if col_dtype is str or col_dtype == 'category':
+            # read_csv reads text and categorical columns as strings, so 101 becomes '101'
+            df[col] = df[col].astype(str).where(df[col].notna())
+        df[col] = df[col].astype(col_dtype)
+    return df
+
+def parse_list_cell(value):
+    """Parse a list stringified by json_to_csv back into a list; single values become one-item lists"""
+    if isinstance(value, str):
+        if value == '':
+            return np.nan
+        if value.startswith('['):
+            try:
+                return ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                # If conversion fails, keep as is
+                return value
+        return [value]
+    return value
+
+def canonical_plan_ids(plan_ids):
+    """Return plan ids as categorical strings, writing integral float ids as integers ('101.0' -> '101').
+    Numeric ids in a column with a missing value come through as floats, and must still match '101'."""
+    plan_ids = plan_ids.astype('category')
+    categories = plan_ids.cat.categories.astype(str)
+    canonical = categories.str.replace(r'^(-?\d+)\.0+$', r'\1', regex=True)
+    return plan_ids.map(dict(zip(plan_ids.cat.categories, canonical))).astype('category')
+
+def read_file_cached(path):
+    """Return (content, etag, mtime) for a file, only re-reading it when it changes on disk"""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _FILE_CACHE.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, 'rb') as f:
+            content = f.read()
+        cached = (signature, content, hashlib.md5(content, usedforsecurity=False).hexdigest(), stat.st_mtime)
+        _FILE_CACHE[path] = cached
+    return cached[1:]
+
+def _safe_divide(numerator, denominator):
+    """Element-wise numerator / denominator, with 0 wherever the denominator is 0"""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+def unique_sheet_name(name, used, suffix=None):
+    """Cut name to Excel's 31-character sheet name limit, adding a ' (n)' suffix until it is
+    not in used (compared case-insensitively, as Excel does), and record the result in used"""
+    while True:
+        tag = f" ({suffix})" if suffix else ''
+        candidate = name[:31 - len(tag)] + tag
+        if candidate.lower() not in used:
+            used.add(candidate.lower())
+            return candidate
+        suffix = (suffix or 1) + 1
+
 def save_excel_file(df: pd.DataFrame, filename: str) -> str:
     """Save DataFrame to Excel file and return the full path"""
     try:
@@ -221,19 +387,32 @@ def serve_file(filepath: str, filename: str = None):
         if filename is None:
             filename = os.path.basename(filepath)
         
-        response = send_file(
-            filepath,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        if X_ACCEL_PREFIX:
+            # Let nginx stream the file; the body of this response is ignored
+            response = app.response_class(
+                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX.rstrip('/')}/{os.path.basename(filepath)}"
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        else:
+            # Serve from memory; the report is only read from disk again after it is rewritten
+            content, etag, modified = read_file_cached(filepath)
+            response = app.response_class(
+                content,
+                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+            response.set_etag(etag)
+            response.last_modified = modified
+            # Answer If-None-Match/If-Modified-Since with 304 and honour Range requests
+            response.make_conditional(request, accept_ranges=True, complete_length=len(content))
         
         # Add CORS headers
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Expose-Headers', 'Content-Disposition')
-        response.headers.add('Cache-Control', 'no-cache, no-store, must-revalidate')
-        response.headers.add('Pragma', 'no-cache')
-        response.headers.add('Expires', '0')
+        # Revalidate on every request so a regenerated report is never served stale,
+        # while an unchanged file can still be answered with 304 Not Modified
+        response.headers['Cache-Control'] = 'no-cache, must-revalidate'
         
         logger.info(f"Successfully serving file: {filepath} as {filename}")
         return response
@@ -286,10 +465,14 @@ def process_data():
         # Use the local PlannerRankerSystem class instead of importing
         # No need to import from planner.py anymore
         
-        # Save JSON data to temporary files
+        # Build the input frames straight from the JSON data
         try:
-            historical_file = json_to_csv(data['historical_data'], 'historical_data.csv')
-            user_input_file = json_to_csv(data['user_input'], 'user_input.csv')
+            historical_df = records_to_frame(data['historical_data'])
+            user_input_df = records_to_frame(data['user_input'])
+            if PLANNER_DEBUG:
+                # Keep CSV copies of the inputs for debugging
+                json_to_csv(data['historical_data'], 'historical_data.csv')
+                json_to_csv(data['user_input'], 'user_input.csv')
         except Exception as e:
             print(f"Error processing input data: {str(e)}")
             return jsonify({"error": f"Failed to process input data: {str(e)}"}), 400
@@ -300,7 +483,9 @@ def process_data():
         
         # Initialize the PlannerRankerSystem
         try:
-            ranker = PlannerRankerSystem(historical_file, user_input_file, weights)
+            ranker = PlannerRankerSystem(
+                weights=weights, historical_df=historical_df, user_input_df=user_input_df
+            )
         except Exception as e:
             print(f"Error initializing PlannerRankerSystem: {str(e)}")
             return jsonify({"error": f"Failed to initialize ranking system: {str(e)}"}), 500
@@ -336,28 +521,11 @@ def process_data():
             print(f"Error calculating distribution count: {str(e)}")
             return jsonify({"error": f"Failed to calculate distribution count: {str(e)}"}), 500
         
-        # Store the final rankings for the get-rankings endpoint
-        global latest_rankings
-        
-        # Convert the final_rankings DataFrame to a list of dictionaries
-        all_publishers_data = final_rankings.to_dict('records')
+        # Make sure the queued Excel reports are on disk before they are reported or served
+        ranker.wait_for_io()
         
-        # Group rankings by publisher and ensure all needed fields are present
-        by_publisher = {}
-        for record in all_publishers_data:
-            record.setdefault('expected_clicks', 0) 
-            record.setdefault('budget_cap', 0)
-            
-            publisher = record.get('publisher', 'Unknown')
-            if publisher not in by_publisher:
-                by_publisher[publisher] = []
-            by_publisher[publisher].append(record)
-        
-        # Store the latest rankings
-        latest_rankings = {
-            "all_publishers": all_publishers_data,
-            "by_publisher": by_publisher
-        }
+        # Store the final rankings for the get-rankings endpoint
+        store_latest_rankings(final_rankings)
         
         # Check if performance report was created
         performance_report_path = os.path.join(OUTPUT_FOLDER, 'overall_performance_report.xlsx')
@@ -379,24 +547,13 @@ def process_data():
 @app.route('/api/get-rankings', methods=['GET'])
 def get_rankings():
     """Return the latest ranking results"""
-    global latest_rankings
-    
-    if not latest_rankings["all_publishers"]:
+    # Read the payload once; it is empty until a run with rankings has been stored
+    rankings_json = latest_rankings_json
+    if not rankings_json:
         return jsonify({"error": "No ranking data available"}), 404
 
-    # Ensure all required fields are present in the response
-    for record in latest_rankings["all_publishers"]:
-        record.setdefault('expected_clicks', 0)
-        record.setdefault('budget_cap', 0)
-        record.setdefault('CTR', 0)
-        record.setdefault('EPC', 0)
-        record.setdefault('avg_revenue', 0)
-        record.setdefault('distribution', 0)
-        record.setdefault('final_rank', 0)
-        record.setdefault('tags', '')
-        record.setdefault('subcategory', '')
-
-    return jsonify(latest_rankings)
+    # Defaults were filled in and the payload serialized when the rankings were stored
+    return app.response_class(rankings_json, mimetype='application/json')
 
 @app.route('/api/get-performance-data', methods=['GET'])
 def get_performance_data():
@@ -553,32 +710,29 @@ class handler(BaseHTTPRequestHandler):
         }, status=404)
     
     def _send_json_response(self, data, status=200):
-        """Helper to send a JSON response with CORS headers"""
+        """Helper to send a JSON response with CORS headers; data may be already-encoded JSON bytes"""
         self.send_response(status)
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(data if isinstance(data, bytes) else json.dumps(data).encode())
     
     def _serve_file(self, filepath, filename):
         """Serve a file for download"""
         try:
             if os.path.exists(filepath):
-                # Read the file
                 with open(filepath, 'rb') as file:
-                    content = file.read()
-                
-                # Send headers
-                self.send_response(200)
-                self.send_header('Content-type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
-                self.send_header('Content-Length', str(len(content)))
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Expose-Headers', 'Content-Disposition')
-                self.end_headers()
-                
-                # Send the file content
-                self.wfile.write(content)
+                    # Send headers
+                    self.send_response(200)
+                    self.send_header('Content-type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+                    self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+                    self.send_header('Content-Length', str(os.fstat(file.fileno()).st_size))
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.send_header('Access-Control-Expose-Headers', 'Content-Disposition')
+                    self.end_headers()
+                    
+                    # Stream the file content in chunks rather than reading it into memory
+                    shutil.copyfileobj(file, self.wfile)
             else:
                 # File not found
                 logger.error(f"File not found: {filepath}")
@@ -597,25 +751,14 @@ class handler(BaseHTTPRequestHandler):
     def _handle_get_rankings(self):
         """Handle GET /api/get-rankings endpoint"""
         try:
-            global latest_rankings
-            
-            if not latest_rankings["all_publishers"]:
+            # Read the payload once; it is empty until a run with rankings has been stored
+            rankings_json = latest_rankings_json
+            if not rankings_json:
                 self._send_json_response({"error": "No ranking data available"}, status=404)
                 return
                 
-            # Ensure all required fields are present in the response
-            for record in latest_rankings["all_publishers"]:
-                record.setdefault('expected_clicks', 0)
-                record.setdefault('budget_cap', 0)
-                record.setdefault('CTR', 0)
-                record.setdefault('EPC', 0)
-                record.setdefault('avg_revenue', 0)
-                record.setdefault('distribution', 0)
-                record.setdefault('final_rank', 0)
-                record.setdefault('tags', '')
-                record.setdefault('subcategory', '')
-                
-            self._send_json_response(latest_rankings)
+            # Defaults were filled in and the payload serialized when the rankings were stored
+            self._send_json_response(rankings_json)
             
         except Exception as e:
             logger.exception(f"Error getting rankings: {str(e)}")
@@ -685,10 +828,14 @@ class handler(BaseHTTPRequestHandler):
                 }, status=400)
                 return
             
-            # Save JSON data to temporary files
+            # Build the input frames straight from the JSON data
             try:
-                historical_file = json_to_csv(data['historical_data'], 'historical_data.csv')
-                user_input_file = json_to_csv(data['user_input'], 'user_input.csv')
+                historical_df = records_to_frame(data['historical_data'])
+                user_input_df = records_to_frame(data['user_input'])
+                if PLANNER_DEBUG:
+                    # Keep CSV copies of the inputs for debugging
+                    json_to_csv(data['historical_data'], 'historical_data.csv')
+                    json_to_csv(data['user_input'], 'user_input.csv')
             except Exception as e:
                 logger.exception(f"Error processing input data: {str(e)}")
                 self._send_json_response({
@@ -702,7 +849,9 @@ class handler(BaseHTTPRequestHandler):
             
             # Initialize the PlannerRankerSystem
             try:
-                ranker = PlannerRankerSystem(historical_file, user_input_file, weights)
+                ranker = PlannerRankerSystem(
+                    weights=weights, historical_df=historical_df, user_input_df=user_input_df
+                )
             except Exception as e:
                 logger.exception(f"Error initializing PlannerRankerSystem: {str(e)}")
                 self._send_json_response({
@@ -756,28 +905,11 @@ class handler(BaseHTTPRequestHandler):
                 }, status=500)
                 return
             
-            # Store the final rankings for the get-rankings endpoint
-            global latest_rankings
-            
-            # Convert the final_rankings DataFrame to a list of dictionaries
-            all_publishers_data = final_rankings.to_dict('records')
+            # Make sure the queued Excel reports are on disk before they are reported or served
+            ranker.wait_for_io()
             
-            # Group rankings by publisher and ensure all needed fields are present
-            by_publisher = {}
-            for record in all_publishers_data:
-                record.setdefault('expected_clicks', 0) 
-                record.setdefault('budget_cap', 0)
-                
-                publisher = record.get('publisher', 'Unknown')
-                if publisher not in by_publisher:
-                    by_publisher[publisher] = []
-                by_publisher[publisher].append(record)
-            
-            # Store the latest rankings
-            latest_rankings = {
-                "all_publishers": all_publishers_data,
-                "by_publisher": by_publisher
-            }
+            # Store the final rankings for the get-rankings endpoint
+            store_latest_rankings(final_rankings)
             
             # Check if performance report was created
             performance_report_path = PERFORMANCE_FILE
@@ -838,9 +970,38 @@ def check_epc_alerts(metrics):
 
 # Implementation of PlannerRankerSystem class
 class PlannerRankerSystem:
-    def __init__(self, historical_data_path, user_input_path, weights=None):
+    # Historical columns the pipeline uses; publisher/plan_id are categorical so
+    # groupby and joins compare integer codes. Counts stay float64 so missing or
+    # fractional values are summed the way an inferred read would.
+    HIST_USECOLS = ('publisher', 'plan_id', 'clicks', 'distribution', 'revenue')
+    HIST_DTYPES = {
+        'publisher': 'category',
+        'plan_id': 'category',
+        'clicks': 'float64',
+        'distribution': 'float64',
+        'revenue': 'float64'
+    }
+    
+    # User input columns the distribution step reads; plan_id stays text until it is
+    # given the categories shared with the historical data
+    UI_USECOLS = (
+        'publisher', 'plan_id', 'tags', 'subcategory', 'distribution',
+        'clicks_to_be_delivered', 'budget_cap', 'expected_clicks'
+    )
+    UI_DTYPES = {
+        'plan_id': str,
+        'subcategory': 'category',
+        'distribution': 'float64',
+        'clicks_to_be_delivered': 'float64',
+        'budget_cap': 'float64',
+        'expected_clicks': 'float64'
+    }
+    
+    def __init__(self, historical_data_path=None, user_input_path=None, weights=None,
+                 historical_df=None, user_input_df=None):
         """
-        Initialize the Planner Ranker System
+        Initialize the Planner Ranker System from CSV paths, or from DataFrames
+        built directly from the request JSON (historical_df / user_input_df)
         """
         logger.info("Initializing Planner Ranker System")
         # Default weights if not provided or invalid
@@ -856,63 +1017,109 @@ class PlannerRankerSystem:
         
         logger.info(f"Initialized with weights: {self.weights}")
         
-        # Load the data
-        self.historical_data = pd.read_csv(historical_data_path)
-        self.user_input = pd.read_csv(user_input_path)
-        
-        # Process publisher arrays if they're stored as strings
-        if 'publisher' in self.user_input.columns:
-            try:
-                # Try to convert string representations of lists to actual lists
-                self.user_input['publisher'] = self.user_input['publisher'].apply(
-                    lambda x: eval(x) if isinstance(x, str) and x.startswith('[') else [x] if isinstance(x, str) else x
-                )
-            except:
-                # If conversion fails, keep as is
-                pass
-        
-        # Process tags arrays if they're stored as strings
-        if 'tags' in self.user_input.columns:
-            try:
-                # Try to convert string representations of lists to actual lists
-                self.user_input['tags'] = self.user_input['tags'].apply(
-                    lambda x: eval(x) if isinstance(x, str) and x.startswith('[') else [x] if isinstance(x, str) else x
-                )
-            except:
-                # If conversion fails, keep as is
-                pass
+        # Load the data, only keeping the columns the pipeline uses. Missing optional
+        # columns are tolerated, hence the callable usecols.
+        if historical_df is not None:
+            self.historical_data = normalize_input_frame(
+                historical_df, self.HIST_USECOLS, self.HIST_DTYPES
+            )
+        else:
+            self.historical_data = pd.read_csv(
+                historical_data_path,
+                usecols=lambda col: col in self.HIST_USECOLS,
+                dtype=self.HIST_DTYPES
+            )
+        # Parse the publisher/tags lists (stringified in CSVs) into Python lists
+        list_converters = {'publisher': parse_list_cell, 'tags': parse_list_cell}
+        if user_input_df is not None:
+            self.user_input = normalize_input_frame(
+                user_input_df, self.UI_USECOLS, self.UI_DTYPES, converters=list_converters
+            )
+        else:
+            self.user_input = pd.read_csv(
+                user_input_path,
+                usecols=lambda col: col in self.UI_USECOLS,
+                dtype=self.UI_DTYPES,
+                converters=list_converters
+            )
+
+        # Give both frames the same plan_id categories so joins between them stay on integer codes
+        if 'plan_id' in self.user_input.columns:
+            for frame in (self.historical_data, self.user_input):
+                frame['plan_id'] = canonical_plan_ids(frame['plan_id'])
+            plan_ids = union_categoricals([
+                self.historical_data['plan_id'],
+                self.user_input['plan_id']
+            ]).categories
+            # Numeric ids get numeric categories back, so they are written, returned and
+            # sorted as numbers like read_csv inferred them, not as strings ('1', '10', '2')
+            numeric_ids = pd.to_numeric(plan_ids, errors='coerce')
+            if len(plan_ids) and not numeric_ids.isna().any():
+                id_map = dict(zip(plan_ids, numeric_ids))
+                plan_id_dtype = pd.CategoricalDtype(numeric_ids.unique().sort_values())
+                for frame in (self.historical_data, self.user_input):
+                    frame['plan_id'] = frame['plan_id'].map(id_map).astype(plan_id_dtype)
+            else:
+                for frame in (self.historical_data, self.user_input):
+                    frame['plan_id'] = frame['plan_id'].astype(pd.CategoricalDtype(plan_ids))
         
         # Use the global output folder
         self.OUTPUT_FOLDER = OUTPUT_FOLDER
+        
+        # Background Excel writes queued by this run, awaited in wait_for_io
+        self._io_futures = []
+    
+    def _save_in_background(self, df, filepath):
+        """Queue an Excel write of a snapshot of df on the background I/O pool"""
+        future = _IO_POOL.submit(save_dataframe_to_excel, df.copy(), filepath)
+        self._io_futures.append((future, filepath))
+    
+    def _save_debug_dump(self, df, filename):
+        """Save an intermediate pipeline step to the output folder when PLANNER_DEBUG is set"""
+        if PLANNER_DEBUG:
+            self._save_in_background(df, os.path.join(self.OUTPUT_FOLDER, filename))
+    
+    def wait_for_io(self):
+        """Block until all queued background writes have finished"""
+        pending, self._io_futures = self._io_futures, []
+        wait([future for future, _ in pending])
+        for future, filepath in pending:
+            if not future.result():
+                logger.error(f"Failed to save {filepath}")
     
     def calculate_metrics(self):
         """Calculate metrics from historical data"""
         try:
             # Calculate CTR for each row: clicks / distribution (avoid division by zero)
-            self.historical_data['CTR'] = self.historical_data.apply(
-                lambda row: row['clicks'] / row['distribution'] if row['distribution'] > 0 else 0, 
-                axis=1
+            clicks = self.historical_data['clicks'].to_numpy()
+            distribution = self.historical_data['distribution'].to_numpy()
+            self.historical_data['CTR'] = np.divide(
+                clicks, distribution, out=np.zeros(len(clicks)), where=distribution > 0
             )
             
             # Group by publisher and plan_id to calculate total metrics
-            metrics = self.historical_data.groupby(['publisher', 'plan_id']).agg({
-                'CTR': 'mean',  # Average CTR
-                'revenue': 'sum',  # Total revenue
-                'clicks': 'sum',  # Total clicks
-                'distribution': 'sum'  # Total distribution
-            }).reset_index()
+            if HAS_POLARS and len(self.historical_data) >= POLARS_MIN_ROWS:
+                metrics = self._aggregate_metrics_polars()
+            else:
+                metrics = self.historical_data.groupby(['publisher', 'plan_id'], observed=True).agg({
+                    'CTR': 'mean',  # Average CTR
+                    'revenue': 'sum',  # Total revenue
+                    'clicks': 'sum',  # Total clicks
+                    'distribution': 'sum'  # Total distribution
+                }).reset_index()
             
             # Calculate EPC as total revenue divided by total clicks
-            metrics['EPC'] = metrics.apply(
-                lambda row: row['revenue'] / row['clicks'] if row['clicks'] > 0 else 0,
-                axis=1
+            total_clicks = metrics['clicks'].to_numpy()
+            total_revenue = metrics['revenue'].to_numpy()
+            metrics['EPC'] = np.divide(
+                total_revenue, total_clicks, out=np.zeros(len(total_clicks)), where=total_clicks > 0
             )
             
             # Rename revenue column to avg_revenue for clarity
             metrics = metrics.rename(columns={'revenue': 'avg_revenue'})
             
-            # Save metrics to Excel
-            save_dataframe_to_excel(metrics, os.path.join(self.OUTPUT_FOLDER, 'step1_avg_metrics.xlsx'))
+            # Save metrics to Excel (debug only)
+            self._save_debug_dump(metrics, 'step1_avg_metrics.xlsx')
             
             return metrics
             
@@ -920,56 +1127,69 @@ class PlannerRankerSystem:
             logger.exception(f"Error calculating metrics: {str(e)}")
             raise
     
+    def _aggregate_metrics_polars(self):
+        """Same aggregation as the pandas groupby in calculate_metrics, run with polars' multi-threaded group_by"""
+        logger.info(f"Aggregating {len(self.historical_data)} historical rows with polars")
+        data = self.historical_data
+        publisher_dtype = data['publisher'].dtype
+        plan_id_dtype = data['plan_id'].dtype
+        
+        # Group on the categorical codes; rows with a missing key (code -1) are dropped like pandas does.
+        # NaN becomes null so mean/sum skip missing values the way pandas does, instead of propagating NaN
+        aggregated = (
+            pl.DataFrame({
+                'publisher': data['publisher'].cat.codes.to_numpy(),
+                'plan_id': data['plan_id'].cat.codes.to_numpy(),
+                'CTR': data['CTR'].to_numpy(),
+                'revenue': data['revenue'].to_numpy(),
+                'clicks': data['clicks'].to_numpy(),
+                'distribution': data['distribution'].to_numpy()
+            }, nan_to_null=True)
+            .filter((pl.col('publisher') >= 0) & (pl.col('plan_id') >= 0))
+            .group_by(['publisher', 'plan_id'])
+            .agg(
+                pl.col('CTR').mean(),
+                pl.col('revenue').sum(),
+                pl.col('clicks').sum(),
+                pl.col('distribution').sum()
+            )
+            .sort(['publisher', 'plan_id'])
+        )
+        # Convert column by column through numpy; DataFrame.to_pandas() would require pyarrow
+        aggregated = pd.DataFrame({col: aggregated[col].to_numpy() for col in aggregated.columns})
+        
+        # Restore the categorical keys, in the same order the pandas groupby returns them
+        aggregated['publisher'] = pd.Categorical.from_codes(aggregated['publisher'], dtype=publisher_dtype)
+        aggregated['plan_id'] = pd.Categorical.from_codes(aggregated['plan_id'], dtype=plan_id_dtype)
+        return aggregated
+    
     def calculate_ranks(self, metrics):
         """Calculate rank for each metric within each publisher"""
         logger.info("Calculating ranks from metrics")
         
         try:
-            # Group by publisher and rank each metric in descending order
-            ranked_data = metrics.copy()
-            
-            # Replace any NaN values with 0
-            ranked_data = ranked_data.fillna(0)
-            
-            # For each publisher, rank the metrics (higher values get better ranks)
-            publishers = ranked_data['publisher'].unique()
-            
-            for publisher in publishers:
-                publisher_mask = ranked_data['publisher'] == publisher
-                publisher_data = ranked_data[publisher_mask]
-                
-                if len(publisher_data) > 0:
-                    # Ensure there are enough non-zero values to rank
-                    ctr_values = publisher_data['CTR'].values
-                    epc_values = publisher_data['EPC'].values
-                    revenue_values = publisher_data['avg_revenue'].values
-                    
-                    # Initialize ranks with default value 1 (top rank)
-                    ranked_data.loc[publisher_mask, 'CTR_rank'] = 1
-                    ranked_data.loc[publisher_mask, 'EPC_rank'] = 1
-                    ranked_data.loc[publisher_mask, 'avg_revenue_rank'] = 1
-                    
-                    # Only rank if we have more than one row and at least one non-zero value
-                    if len(publisher_data) > 1:
-                        # Rank CTR (descending) if we have any non-zero values
-                        if np.sum(ctr_values > 0) > 0:
-                            ranked_data.loc[publisher_mask, 'CTR_rank'] = ranked_data.loc[publisher_mask, 'CTR'].rank(ascending=False, method='min')
-                        
-                        # Rank EPC (descending) if we have any non-zero values
-                        if np.sum(epc_values > 0) > 0:
-                            ranked_data.loc[publisher_mask, 'EPC_rank'] = ranked_data.loc[publisher_mask, 'EPC'].rank(ascending=False, method='min')
-                        
-                        # Rank Revenue (descending) if we have any non-zero values
-                        if np.sum(revenue_values > 0) > 0:
-                            ranked_data.loc[publisher_mask, 'avg_revenue_rank'] = ranked_data.loc[publisher_mask, 'avg_revenue'].rank(ascending=False, method='min')
-            
-            # Ensure no NaN values in rank columns
-            ranked_data['CTR_rank'] = ranked_data['CTR_rank'].fillna(1)
-            ranked_data['EPC_rank'] = ranked_data['EPC_rank'].fillna(1)
-            ranked_data['avg_revenue_rank'] = ranked_data['avg_revenue_rank'].fillna(1)
-            
-            # Save ranked data to Excel
-            save_dataframe_to_excel(ranked_data, os.path.join(self.OUTPUT_FOLDER, 'step2_ranked_metrics.xlsx'))
+            # Replace any NaN values in the ranked metrics with 0. Stages only add columns
+            # from here on, so they all work on the metrics frame in place.
+            ranked_data = metrics
+            for col in ('CTR', 'EPC', 'avg_revenue'):
+                ranked_data[col] = ranked_data[col].fillna(0)
+            
+            # Rank each metric within its publisher (higher values get better ranks).
+            # A metric with no positive values in a publisher keeps the default rank of 1.
+            by_publisher = ranked_data.groupby('publisher', observed=True)
+            for metric, rank_column in (('CTR', 'CTR_rank'), ('EPC', 'EPC_rank'), ('avg_revenue', 'avg_revenue_rank')):
+                ranks = by_publisher[metric].rank(ascending=False, method='min')
+                has_positive = by_publisher[metric].transform('max') > 0
+                ranked_data[rank_column] = ranks.where(has_positive, 1)
+            
+            # Ensure no NaN values in rank columns; ranks are whole numbers, so int32 holds them
+            # (int16 would wrap to negative above 32767 plans per publisher)
+            ranked_data['CTR_rank'] = ranked_data['CTR_rank'].fillna(1).astype('int32')
+            ranked_data['EPC_rank'] = ranked_data['EPC_rank'].fillna(1).astype('int32')
+            ranked_data['avg_revenue_rank'] = ranked_data['avg_revenue_rank'].fillna(1).astype('int32')
+            
+            # Save ranked data to Excel (debug only)
+            self._save_debug_dump(ranked_data, 'step2_ranked_metrics.xlsx')
             
             return ranked_data
             
@@ -982,10 +1202,8 @@ class PlannerRankerSystem:
         logger.info("Calculating weighted rank from ranked data")
         
         try:
-            weighted_data = ranked_data.copy()
-            
-            # Ensure no NaN values
-            weighted_data = weighted_data.fillna(0)
+            # Work on the ranked frame in place, it is not reused by the caller
+            weighted_data = ranked_data
             
             # Check if rank columns exist
             required_columns = ['CTR_rank', 'EPC_rank', 'avg_revenue_rank']
@@ -1004,12 +1222,23 @@ class PlannerRankerSystem:
                 epc_weight = float(self.weights.get('EPC', 0.33))
                 revenue_weight = float(self.weights.get('Revenue', 0.33))
                 
-                # Calculate the weighted rank
-                weighted_data['weighted_rank'] = (
-                    ctr_weight * weighted_data['CTR_rank'] +
-                    epc_weight * weighted_data['EPC_rank'] +
-                    revenue_weight * weighted_data['avg_revenue_rank']
-                )
+                if HAS_NUMEXPR and len(weighted_data) >= NUMEXPR_MIN_ROWS:
+                    # Large frames: numexpr fuses the multiplies and adds into one cache-sized, threaded pass
+                    weighted_data.eval(
+                        'weighted_rank = @ctr_weight * CTR_rank + @epc_weight * EPC_rank'
+                        ' + @revenue_weight * avg_revenue_rank',
+                        engine='numexpr',
+                        inplace=True
+                    )
+                else:
+                    # Calculate the weighted rank on the float64 rank columns, summed left to right;
+                    # a BLAS matrix product may fuse or reorder the adds and break exact ties differently
+                    ranks = weighted_data[required_columns].to_numpy(dtype=np.float64)
+                    weighted_data['weighted_rank'] = (
+                        ctr_weight * ranks[:, 0] +
+                        epc_weight * ranks[:, 1] +
+                        revenue_weight * ranks[:, 2]
+                    )
             except Exception as e:
                 logger.error(f"Error calculating weighted rank: {str(e)}")
                 # If calculation fails, set a default weighted rank of 1
@@ -1018,8 +1247,8 @@ class PlannerRankerSystem:
             # Replace any NaN in weighted_rank with 1
             weighted_data['weighted_rank'] = weighted_data['weighted_rank'].fillna(1)
             
-            # Save weighted data to Excel
-            save_dataframe_to_excel(weighted_data, os.path.join(self.OUTPUT_FOLDER, 'step3_weighted_ranks.xlsx'))
+            # Save weighted data to Excel (debug only)
+            self._save_debug_dump(weighted_data, 'step3_weighted_ranks.xlsx')
             
             return weighted_data
             
@@ -1032,36 +1261,21 @@ class PlannerRankerSystem:
         logger.info("Calculating final rank from weighted data")
         
         try:
-            final_data = weighted_data.copy()
-            
-            # Ensure no NaN values
-            final_data = final_data.fillna(0)
-            
-            # For each publisher, rank based on weighted rank (ascending order - lower weighted rank is better)
-            publishers = final_data['publisher'].unique()
-            
-            # Initialize final_rank with default value 1
-            final_data['final_rank'] = 1
-            
-            for publisher in publishers:
-                publisher_mask = final_data['publisher'] == publisher
-                publisher_data = final_data[publisher_mask]
-                
-                if len(publisher_data) > 0:
-                    # Only rank if we have more than one row
-                    if len(publisher_data) > 1:
-                        try:
-                            final_data.loc[publisher_mask, 'final_rank'] = final_data.loc[publisher_mask, 'weighted_rank'].rank(method='min')
-                        except Exception as e:
-                            logger.error(f"Error ranking for publisher {publisher}: {str(e)}")
-                            # Keep default rank of 1
-            
-            # Ensure no NaN values in final_rank
-            final_data['final_rank'] = final_data['final_rank'].fillna(1)
+            # Work on the weighted frame in place, it is not reused by the caller
+            final_data = weighted_data
+            
+            # Rank within each publisher in one grouped pass (ascending order - lower
+            # weighted rank is better); a publisher with a single plan ranks 1.
+            # 'min' ranks are whole numbers, kept as integers like the per-publisher loop produced
+            final_data['final_rank'] = (
+                final_data.groupby('publisher', observed=True)['weighted_rank']
+                .rank(method='min')
+                .fillna(1)
+                .astype('int64')
+            )
             
             # Save rankings file
-            if not save_dataframe_to_excel(final_data, RANKING_FILE):
-                logger.error("Failed to save rankings file")
+            self._save_in_background(final_data, RANKING_FILE)
             
             # Create overall performance report
             self.create_overall_performance_report(final_data)
@@ -1078,41 +1292,20 @@ class PlannerRankerSystem:
         
         formatted_output = final_output.copy()
         
-        # Round distribution to integers
-        if 'distribution' in formatted_output.columns:
-            formatted_output['distribution'] = formatted_output['distribution'].apply(
-                lambda x: round(x) if pd.notnull(x) else 0
-            )
-        
-        # Round revenue to integers
-        if 'avg_revenue' in formatted_output.columns:
-            formatted_output['avg_revenue'] = formatted_output['avg_revenue'].apply(
-                lambda x: round(x) if pd.notnull(x) else 0
-            )
+        # Round distribution, revenue, expected_clicks and budget_cap to integers
+        for col in ('distribution', 'avg_revenue', 'expected_clicks', 'budget_cap'):
+            if col in formatted_output.columns:
+                values = formatted_output[col].to_numpy(dtype=np.float64)
+                formatted_output[col] = np.where(np.isnan(values), 0, np.rint(values)).astype('int64')
         
-        # Round EPC to 2 decimal places
+        # Round EPC to 2 decimal places. Vectorized rounding is half-to-even on the
+        # scaled value, so an exact-half double like 1.405 can display as 1.40
         if 'EPC' in formatted_output.columns:
-            formatted_output['EPC'] = formatted_output['EPC'].apply(
-                lambda x: round(x, 2) if pd.notnull(x) else 0
-            )
+            formatted_output['EPC'] = formatted_output['EPC'].astype(np.float64).round(2).fillna(0)
             
         # Format CTR as percentage with 2 decimal places
         if 'CTR' in formatted_output.columns:
-            formatted_output['CTR'] = formatted_output['CTR'].apply(
-                lambda x: round(x * 100, 2) if pd.notnull(x) else 0
-            )
-            
-        # Round expected_clicks to integers
-        if 'expected_clicks' in formatted_output.columns:
-            formatted_output['expected_clicks'] = formatted_output['expected_clicks'].apply(
-                lambda x: round(x) if pd.notnull(x) else 0
-            )
-            
-        # Round budget_cap to integers
-        if 'budget_cap' in formatted_output.columns:
-            formatted_output['budget_cap'] = formatted_output['budget_cap'].apply(
-                lambda x: round(x) if pd.notnull(x) else 0
-            )
+            formatted_output['CTR'] = (formatted_output['CTR'].astype(np.float64) * 100).round(2).fillna(0)
         
         return formatted_output
     
@@ -1121,20 +1314,14 @@ class PlannerRankerSystem:
         logger.info("Creating overall performance report")
         
         try:
-            # Make a copy of the data to avoid modifying the original
-            report_data = final_data.copy()
+            # Format numbers for better readability (returns a copy, final_data is untouched)
+            report_data = self.format_ranking_data(final_data)
             
             # Add calculated fields for the report
-            report_data['expected_distribution'] = report_data['distribution'] if 'distribution' in report_data.columns else 0
-            
-            # Format numbers for better readability
-            report_data = self.format_ranking_data(report_data)
+            report_data['expected_distribution'] = final_data['distribution'] if 'distribution' in final_data.columns else 0
             
             # Save performance report
-            if not save_dataframe_to_excel(report_data, PERFORMANCE_FILE):
-                logger.error("Failed to save performance report")
-            else:
-                logger.info("Successfully saved performance report")
+            self._save_in_background(report_data, PERFORMANCE_FILE)
             
         except Exception as e:
             logger.exception(f"Error creating overall performance report: {str(e)}")
@@ -1144,121 +1331,92 @@ class PlannerRankerSystem:
         """Calculate distribution count based on tags and historical data ratios"""
         logger.info("Calculating distribution count based on tags and historical ratios")
         
-        # Create a list to store merged rows
-        result_rows = []
-        
         # Calculate historical totals for each publisher
-        historical_totals = self.historical_data.groupby(['publisher', 'plan_id']).agg({
+        historical_totals = self.historical_data.groupby(['publisher', 'plan_id'], observed=True).agg({
             'revenue': 'sum',
             'clicks': 'sum',
             'distribution': 'sum'
         }).reset_index()
         
-        # For each plan in final_data
-        for _, plan_row in final_data.iterrows():
-            # Find matching user input rows
-            matches = []
-            for _, user_row in self.user_input.iterrows():
-                # Check if plan_id matches and publisher is in the publisher array
-                publisher_match = False
-                if isinstance(user_row['publisher'], list):
-                    publisher_match = plan_row['publisher'] in user_row['publisher']
-                else:
-                    publisher_match = plan_row['publisher'] == user_row['publisher']
-                
-                if user_row['plan_id'] == plan_row['plan_id'] and publisher_match:
-                    matches.append(user_row)
-            
-            # Process each matching row
-            for user_row in matches:
-                # Create a merged row
-                merged_row = plan_row.copy()
-                
-                # Extract tags
-                tags = user_row['tags']
-                if isinstance(tags, list):
-                    tag = tags[0] if tags else ''
-                else:
-                    tag = tags
-                
-                # Add tag to merged row
-                merged_row['tags'] = tag
-                
-                # Get all publishers for this plan_id from user input
-                plan_publishers = []
-                if isinstance(user_row['publisher'], list):
-                    plan_publishers = user_row['publisher']
-                else:
-                    plan_publishers = [user_row['publisher']]
-                
-                # Filter historical totals for this plan's publishers
-                plan_historical = historical_totals[
-                    (historical_totals['plan_id'] == plan_row['plan_id']) & 
-                    (historical_totals['publisher'].isin(plan_publishers))
-                ]
-                
-                # Calculate distribution based on tag type
-                if tag == 'FOC':
-                    # FOC: Distribute clicks based on historical clicks ratio
-                    total_clicks = plan_historical['clicks'].sum()
-                    if total_clicks > 0:
-                        clicks_ratio = plan_historical[
-                            plan_historical['publisher'] == plan_row['publisher']
-                        ]['clicks'].sum() / total_clicks
-                        clicks_to_deliver = user_row.get('clicks_to_be_delivered', 0)
-                        merged_row['expected_clicks'] = round(clicks_to_deliver * clicks_ratio)
-                        merged_row['distribution'] = round(merged_row['expected_clicks'] / merged_row['CTR']) if merged_row['CTR'] > 0 else 0
-                    else:
-                        merged_row['expected_clicks'] = 0
-                        merged_row['distribution'] = 0
-                
-                elif tag == 'Mandatory':
-                    # Mandatory: Distribute based on historical distribution ratio
-                    total_distribution = plan_historical['distribution'].sum()
-                    if total_distribution > 0:
-                        distribution_ratio = plan_historical[
-                            plan_historical['publisher'] == plan_row['publisher']
-                        ]['distribution'].sum() / total_distribution
-                        total_distribution_count = user_row.get('distribution', 0)
-                        merged_row['distribution'] = round(total_distribution_count * distribution_ratio)
-                        merged_row['expected_clicks'] = round(merged_row['distribution'] * merged_row['CTR'])
-                    else:
-                        merged_row['distribution'] = 0
-                        merged_row['expected_clicks'] = 0
-                
-                elif tag == 'Paid':
-                    # Paid: Distribute budget based on historical revenue ratio
-                    total_revenue = plan_historical['revenue'].sum()
-                    if total_revenue > 0:
-                        revenue_ratio = plan_historical[
-                            plan_historical['publisher'] == plan_row['publisher']
-                        ]['revenue'].sum() / total_revenue
-                        total_budget = user_row.get('budget_cap', 0)
-                        merged_row['budget_cap'] = round(total_budget * revenue_ratio)
-                        # Calculate distribution based on budget and EPC
-                        if merged_row['EPC'] > 0 and merged_row['CTR'] > 0:
-                            expected_clicks = merged_row['budget_cap'] / merged_row['EPC']
-                            merged_row['expected_clicks'] = round(expected_clicks)
-                            merged_row['distribution'] = round(expected_clicks / merged_row['CTR'])
-                        else:
-                            merged_row['expected_clicks'] = 0
-                            merged_row['distribution'] = 0
-                    else:
-                        merged_row['budget_cap'] = 0
-                        merged_row['expected_clicks'] = 0
-                        merged_row['distribution'] = 0
-                
-                # Add subcategory and other user input fields
-                for col in user_row.index:
-                    if col not in merged_row.index:
-                        merged_row[col] = user_row[col]
-                
-                # Add to result rows
-                result_rows.append(merged_row)
+        # One row per (user input row, listed publisher); a publisher listed twice counts once
+        user_rows = self.user_input.copy()
+        user_rows['_user_row'] = np.arange(len(user_rows))
+        user_rows['publisher'] = user_rows['publisher'].map(lambda x: x if isinstance(x, list) else [x])
+        user_rows = user_rows.explode('publisher').drop_duplicates(['_user_row', 'publisher'])
         
-        # Convert to DataFrame
-        if result_rows:
-            result = pd.DataFrame(result_rows)
+        # Use the historical publisher categories so both joins below compare integer codes;
+        # publishers with no history become NaN and, like before, match no plan
+        user_rows['publisher'] = user_rows['publisher'].astype(self.historical_data['publisher'].dtype)
+        
+        # Only the first tag of each user input row drives the distribution
+        user_rows['tags'] = user_rows['tags'].map(
+            lambda tags: (tags[0] if tags else '') if isinstance(tags, list) else tags
+        )
+        
+        # Each publisher's share of the plan's historical totals across the publishers listed in that row
+        shares = user_rows[['_user_row', 'publisher', 'plan_id']].merge(
+            historical_totals, on=['publisher', 'plan_id'], how='left'
+        )
+        own = shares[['revenue', 'clicks', 'distribution']].fillna(0).astype(np.float64)
+        totals = own.groupby(shares['_user_row'].to_numpy()).transform('sum')
+        for col in ('revenue', 'clicks', 'distribution'):
+            user_rows[f'_total_{col}'] = totals[col].to_numpy()
+            user_rows[f'_{col}_ratio'] = _safe_divide(own[col].to_numpy(), totals[col].to_numpy())
+        
+        # Join every plan in final_data with the user input rows that list its publisher,
+        # keeping plan order and then user input order
+        result = final_data.assign(_plan_row=np.arange(len(final_data))).merge(
+            user_rows, on=['publisher', 'plan_id'], how='inner', suffixes=('', '_ui')
+        ).sort_values(['_plan_row', '_user_row'], kind='stable').reset_index(drop=True)
+        
+        if len(result):
+            def user_column(col):
+                return result[col].to_numpy(dtype=np.float64) if col in result.columns else np.zeros(len(result))
+            
+            # Dispatch on small integer codes: 0 FOC, 1 Mandatory, 2 Paid, -1 any other tag
+            tag_codes = pd.Categorical(result['tags'], categories=['FOC', 'Mandatory', 'Paid']).codes
+            ctr = result['CTR'].to_numpy(dtype=np.float64)
+            epc = result['EPC'].to_numpy(dtype=np.float64)
+            
+            # FOC: Distribute clicks based on historical clicks ratio
+            foc_valid = result['_total_clicks'].to_numpy() > 0
+            clicks_to_deliver = user_column('clicks_to_be_delivered')
+            foc_clicks = np.where(foc_valid, np.rint(clicks_to_deliver * result['_clicks_ratio'].to_numpy()), 0)
+            foc_distribution = np.where(foc_valid & (ctr > 0), np.rint(_safe_divide(foc_clicks, ctr)), 0)
+            
+            # Mandatory: Distribute based on historical distribution ratio
+            mandatory_valid = result['_total_distribution'].to_numpy() > 0
+            total_distribution_count = user_column('distribution_ui')
+            mandatory_distribution = np.where(
+                mandatory_valid, np.rint(total_distribution_count * result['_distribution_ratio'].to_numpy()), 0
+            )
+            mandatory_clicks = np.where(mandatory_valid, np.rint(mandatory_distribution * ctr), 0)
+            
+            # Paid: Distribute budget based on historical revenue ratio, then derive clicks from EPC
+            paid_valid = result['_total_revenue'].to_numpy() > 0
+            total_budget = user_column('budget_cap')
+            paid_budget = np.where(paid_valid, np.rint(total_budget * result['_revenue_ratio'].to_numpy()), 0)
+            paid_ok = paid_valid & (epc > 0) & (ctr > 0)
+            paid_raw_clicks = _safe_divide(paid_budget, epc)
+            paid_clicks = np.where(paid_ok, np.rint(paid_raw_clicks), 0)
+            paid_distribution = np.where(paid_ok, np.rint(_safe_divide(paid_raw_clicks, ctr)), 0)
+            
+            # Rows with any other tag keep the plan distribution and the user input values
+            conditions = [tag_codes == 0, tag_codes == 1, tag_codes == 2]
+            result['distribution'] = np.select(
+                conditions, [foc_distribution, mandatory_distribution, paid_distribution],
+                default=result['distribution'].to_numpy(dtype=np.float64)
+            )
+            result['expected_clicks'] = np.select(
+                conditions, [foc_clicks, mandatory_clicks, paid_clicks],
+                default=result['expected_clicks'].to_numpy(dtype=np.float64)
+                if 'expected_clicks' in result.columns else np.nan
+            )
+            result['budget_cap'] = np.select(
+                conditions[2:], [paid_budget],
+                default=result['budget_cap'].to_numpy(dtype=np.float64)
+                if 'budget_cap' in result.columns else np.nan
+            )
             
             # Select required columns for final output
             columns_to_keep = [
@@ -1276,16 +1434,38 @@ class PlannerRankerSystem:
             # Format the numerical values for better display
             final_output = self.format_ranking_data(final_output)
             
-            # Save Final output to Excel with each publisher in a separate sheet
-            with pd.ExcelWriter(os.path.join(self.OUTPUT_FOLDER, 'final_planner_ranking.xlsx')) as writer:
-                # Save all data to a main sheet
-                final_output.to_excel(writer, sheet_name='All Publishers', index=False)
+            # The single-sheet rankings file queued by calculate_final_rank must land
+            # before it is overwritten below
+            self.wait_for_io()
+            
+            # Save Final output to Excel with each publisher in a separate sheet. xlsxwriter's
+            # constant_memory mode is not used: pandas writes cells column by column and
+            # that mode only keeps the current row, so earlier columns would be dropped.
+            with pd.ExcelWriter(os.path.join(self.OUTPUT_FOLDER, 'final_planner_ranking.xlsx'), engine='xlsxwriter') as writer:
+                # Sheet names written so far; pandas would silently write a repeated name into
+                # the existing sheet, mixing two publishers' rows
+                used_sheet_names = set()
+                
+                # Save all data to a main sheet, unless it would only duplicate a very large output
+                if len(final_output) <= ALL_PUBLISHERS_SHEET_MAX_ROWS:
+                    final_output.to_excel(
+                        writer, sheet_name=unique_sheet_name('All Publishers', used_sheet_names), index=False
+                    )
+                else:
+                    logger.warning(f"Skipping 'All Publishers' sheet for {len(final_output)} rows")
                 
-                # Save each publisher to its own sheet
-                publishers = final_output['publisher'].unique()
-                for publisher in publishers:
-                    publisher_data = final_output[final_output['publisher'] == publisher]
-                    publisher_data.to_excel(writer, sheet_name=publisher, index=False)
+                # Save each publisher to its own sheet (Excel caps sheet names at 31 characters).
+                # final_output is already sorted by publisher, so each sheet is a contiguous slice.
+                publishers = final_output['publisher'].to_numpy()
+                bounds = np.r_[0, np.flatnonzero(publishers[1:] != publishers[:-1]) + 1, len(publishers)]
+                for start, stop in zip(bounds[:-1], bounds[1:]):
+                    for part, part_start in enumerate(range(start, stop, EXCEL_SHEET_MAX_ROWS)):
+                        part_name = unique_sheet_name(
+                            str(publishers[start]), used_sheet_names, suffix=part + 1 if part else None
+                        )
+                        final_output.iloc[part_start:min(part_start + EXCEL_SHEET_MAX_ROWS, stop)].to_excel(
+                            writer, sheet_name=part_name, index=False
+                        )
             
             return final_output
         else: